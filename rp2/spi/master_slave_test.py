@@ -16,6 +16,8 @@ from .spi_master import SpiMaster
 
 
 tsf = asyncio.ThreadSafeFlag()
+rxdone = asyncio.Event()  # Slave has processed a message
+_OBUF = bytes(range(256)) * 2  # Test data
 
 
 def callback():  # Hard ISR
@@ -38,14 +40,17 @@ miso = Pin(3, Pin.OUT, value=0)
 piospi = SpiSlave(buf=bytearray(300), sm_num=0, mosi=mosi, sck=sck, csn=csn, miso=miso)
 
 
-async def send(data):
-    cs(0)  # Assert CS/
-    spi.write(data)  # "Immediate" return: minimal blocking.
-    print("GH01")
-    await tsf.wait()  # Wait for transfer complete (other tasks run)
-    print("GH02")
-    cs(1)  # Deassert CS/
-    await asyncio.sleep_ms(100)
+# Default args: fast lookup of objects used between CS/ transitions
+async def send(data, _cs=cs, _write=spi.write, _tsfwait=tsf.wait):
+    rxdone.clear()
+    _cs(0)  # Assert CS/
+    _write(data)  # "Immediate" return: minimal blocking.
+    await _tsfwait()  # Wait for transfer complete (other tasks run)
+    _cs(1)  # Deassert CS/: slave ISR runs
+    try:  # Wait for slave to process the message
+        await asyncio.wait_for_ms(rxdone.wait(), 1000)
+    except asyncio.TimeoutError:
+        print("Timeout: slave did not receive message.")
     print("Master received", ibuf)
 
 
@@ -54,10 +59,11 @@ async def receive(piospi):
         print(f"Slave received: {len(msg)} bytes:")
         print(bytes(msg))
         print()
+        rxdone.set()
 
 
 async def test():
-    obuf = bytearray(range(512))  # Test data
+    obuf = memoryview(_OBUF)
     # piospi.write(b"Hello from slave", -1)  # Repeat
     rt = asyncio.create_task(receive(piospi))
     await asyncio.sleep_ms(0)  # Ensure receive task is running
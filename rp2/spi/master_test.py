@@ -21,9 +21,10 @@ pin_miso = Pin(16, Pin.IN)
 tsf = asyncio.ThreadSafeFlag()
 
 
-def callback():  # Hard ISR
-    pin_cs(1)  # Decrease deassert time from 724us to 93us
-    tsf.set()  # Flag user code that transfer is complete
+# Default args: fast lookup of objects used in the ISR
+def callback(_cs=pin_cs, _set=tsf.set):  # Hard ISR
+    _cs(1)  # Decrease deassert time from 724us to 93us
+    _set()  # Flag user code that transfer is complete
 
 
 buf = bytearray(100)
@@ -33,12 +34,12 @@ spi = SpiMaster(6, 1_000_000, pin_sck, pin_mosi, callback, miso=pin_miso, ibuf=b
 # spi = SpiMaster(6, 1_000_000, pin_sck, pin_mosi, callback))
 
 
-async def send(data):
-    tsf.clear()  # no effect
-    pin_cs(0)  # Assert CS/
-    spi.write(data)  # "Immediate" return: minimal blocking.
-    await tsf.wait()  # Wait for transfer complete (other tasks run)
-    pin_cs(1)  # Deassert CS/
+async def send(data, _cs=pin_cs, _write=spi.write, _tsfwait=tsf.wait, _tsfclear=tsf.clear):
+    _tsfclear()  # no effect
+    _cs(0)  # Assert CS/
+    _write(data)  # "Immediate" return: minimal blocking.
+    await _tsfwait()  # Wait for transfer complete (other tasks run)
+    _cs(1)  # Deassert CS/
 
 
 async def main():
@@ -15,19 +15,30 @@ csn = Pin(14, Pin.IN)
 miso = Pin(15, Pin.OUT, value=0)
 piospi = SpiSlave(buf=bytearray(300), sm_num=0, mosi=mosi, sck=sck, csn=csn, miso=miso)
 
+# Replies are sent without copying. Two buffers are needed because a message is
+# sent during the transfer after next, while the following reply is being built.
+txbufs = (bytearray(b"Message 000 from slave"), bytearray(b"Message 000 from slave"))
+
+
+def set_msgno(buf, n):  # Write a 3-digit message no. without allocation
+    for i in (10, 9, 8):
+        buf[i] = 0x30 + n % 10
+        n //= 10
+
 
 async def receive(piospi):
     n = 0
     async for msg in piospi:
-        piospi.write(f"Message {n} from slave")
-        n += 1
+        tx = txbufs[n & 1]
+        set_msgno(tx, n)
+        piospi.write(tx, copy=False)
+        n = (n + 1) % 1000
         print(f"Slave received: {len(msg)} bytes:")
         print(bytes(msg))
         print()
 
 
 async def test():
-    obuf = bytearray(range(512))  # Test data
     rt = asyncio.create_task(receive(piospi))
     await asyncio.sleep_ms(0)  # Ensure receive task is running
     print("\nBasic test\n")
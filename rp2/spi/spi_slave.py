@@ -4,8 +4,9 @@
 # Copyright (c) 2025 Peter Hinch
 
 import rp2
-from machine import Pin, mem32
+from machine import Pin, mem32, idle
 import asyncio
+from uctypes import addressof
 from micropython import schedule, alloc_emergency_exception_buf
 
 alloc_emergency_exception_buf(100)
@@ -16,57 +17,90 @@ alloc_emergency_exception_buf(100)
 # 2 CS\
 
 
-@rp2.asm_pio(autopush=True, autopull=True)
-def spi_in():
-    label("escape")  # Just started, transfer ended or overrun attempt.
-    out(y, 32)  # Get maximum byte count (blocking wait)
-    wait(0, pins, 2)  # Wait for CS/ True
-    wrap_target()  # Input a byte
-    set(x, 7)
-    label("bit")  # Await a +ve clock edge or incoming "quit" signal
-    jmp(pin, "next")
-    jmp(not_osre, "done")  # Data received: quit
-    jmp("bit")
-    label("next")  # clk leading edge
-    in_(pins, 1)  # Input a bit MSB first
-    wait(0, pins, 1)  # clk trailing
-    jmp(y_dec, "continue")
-    # Last trailing clock edge received
-    label("overrun")  # An overrun would occur. Wait for CS/ ISR to send data.
-    jmp(not_osre, "done")  # Data received
-    jmp("overrun")
-    label("continue")
-    jmp(x_dec, "bit")  # Post decrement
-    # push()
-    wrap()  # Next byte
-    label("done")  # ISR has sent data
-    out(x, 32)  # Discard it
-    in_(y, 30)  # Return amount of unfilled buffer truncated to 30 bits
-    # Truncation ensures that overrun returns a short int
-    # push()
-    jmp("escape")
+# The PIO programs are assembled for a fixed frame size of 8, 16 or 32 bits. Frames
+# are MSB first.
+
+
+# Bits are autopushed as 32-bit words: the DMA transfers words. Any partial word is
+# pushed at the end of the transfer and unpacked by the ISR. Incoming data is a bit
+# stream, so the frame size affects only the loop structure.
+def make_spi_in(bits):
+    @rp2.asm_pio(autopush=True, autopull=True, push_thresh=32)
+    def spi_in():
+        label("escape")  # Just started, transfer ended or overrun attempt.
+        out(y, 32)  # Get maximum byte count (blocking wait)
+        wait(0, pins, 2)  # Wait for CS/ True
+        wrap_target()  # Input a frame
+        set(x, bits - 1)
+        label("bit")  # Await a +ve clock edge or incoming "quit" signal
+        jmp(pin, "next")
+        jmp(not_osre, "done")  # Data received: quit
+        jmp("bit")
+        label("next")  # clk leading edge
+        in_(pins, 1)  # Input a bit MSB first
+        wait(0, pins, 1)  # clk trailing
+        jmp(y_dec, "continue")
+        # Last trailing clock edge received: an overrun would occur. The bit just input
+        # lies beyond the buffer: the ISR discards it. Stall on the out() in "done"
+        # until the CS/ ISR sends data.
+        jmp("done")
+        label("continue")
+        jmp(x_dec, "bit")  # Post decrement
+        # push()
+        wrap()  # Next frame
+        label("done")  # ISR has sent data
+        out(x, 32)  # Discard it
+        push()  # Partial word (0..3 bytes, + 1 bit on overrun). 0 if on a word boundary.
+        in_(y, 30)  # Return amount of unfilled buffer truncated to 30 bits
+        # Truncation ensures that overrun returns a short int
+        push()
+        jmp("escape")
+
+    return spi_in
 
 
 # in_base = MOSI. Offsets CLK(1), CS/(2)
 # out_base = MISO
-# DMA feeds OSR via autopull
+# DMA feeds OSR via autopull: one frame per DMA transfer.
+
+
+def make_spi_out(bits):
+    @rp2.asm_pio(autopull=True, pull_thresh=bits, out_init=rp2.PIO.OUT_LOW)
+    def spi_out():
+        wait(0, pins, 2)  # Wait for CS/ True
+        wrap_target()
+        set(x, bits - 1)
+        label("bit")
+        wait(0, pins, 1)  # Await clock low
+        out(pins, 1)  # Stalls here if out of data: IRQ resets SM
+        wait(1, pins, 1)  # Await high going clock edge
+        jmp(x_dec, "bit")
+        wrap()
+
+    return spi_out
+
 
+_SIZES = {8: 0, 16: 1, 32: 2}  # Frame bits: DMA transfer size
+# Programs are assembled once, at import. rp2 loads each program object into a PIO
+# once, so instances on the same PIO share them. Assembly temporarily replaces the
+# module globals, so it must not occur while an instance's ISR may run.
+_PROGS = {b: (make_spi_in(b), make_spi_out(b)) for b in _SIZES}  # bits: (in, out)
 
-@rp2.asm_pio(autopull=True, pull_thresh=8, out_init=rp2.PIO.OUT_LOW)
-def spi_out():
-    wait(0, pins, 2)  # Wait for CS/ True
-    wrap_target()
-    set(x, 7)
-    label("bit")
-    wait(0, pins, 1)  # Await clock low
-    out(pins, 1)  # Stalls here if out of data: IRQ resets SM
-    wait(1, pins, 1)  # Await high going clock edge
-    jmp(x_dec, "bit")
-    wrap()
+
+# The read DMA transfers words so receive buffers must be word aligned. A bytearray
+# is always aligned, but a memoryview slice of one may not be.
+def _aligncheck(buf):
+    if addressof(buf) & 3:
+        raise ValueError("Buffer must be word aligned.")
 
 
 class SpiSlave:
-    def __init__(self, buf=None, callback=None, sm_num=0, *, mosi, sck, csn, miso=None):
+    def __init__(
+        self, buf=None, callback=None, sm_num=0, *, mosi, sck, csn, miso=None, bits=8, wqlen=4
+    ):
+        if bits not in _SIZES:
+            raise ValueError("bits must be 8, 16 or 32.")
+
         # Get data request channel for a SM: RP2040 datasheet 2.5.3 RP2350 12.6.4.1
         def dreq(sm, rx=False):
             d = (sm & 3) + ((sm >> 2) << 3)
@@ -74,131 +108,266 @@ class SpiSlave:
 
         self._io = miso is not None
         self._csn = csn
-        self._wq = []  # Write queue
+        # Write queue: a ring of wqlen + 1 slots. One extra slot ensures that .write()
+        # can never reuse the slot being read by the DMA. Buffers are allocated by
+        # .write() and reused.
+        nslots = wqlen + 1
+        self._wqlen = wqlen  # Max. no. of queued messages
+        self._wnslots = nslots
+        self._wbuf = [None] * nslots  # bytearray owned by each slot
+        self._wmv = [None] * nslots  # memoryviews of the above
+        self._wsrc = [None] * nslots  # Queued message: slot's bytearray or user's buffer
+        self._waddr = [0] * nslots  # Address of ._wsrc
+        self._wlen = [0] * nslots  # No. of frames in message
+        self._whead = 0  # Slot of oldest message
+        self._wcount = 0  # No. of queued messages
+        self._wfly = None  # Reference to buffer being read by DMA (may be user's)
+        self._wshift = _SIZES[bits]  # Bytes->frames
         self._callback = callback
         self._docb = False  # By default CB des not run
         # Set up read DMA
         self._dma = rp2.DMA()
-        # Transfer bytes, rather than words, don't increment the read address and pace the transfer.
-        self._cfg = self._dma.pack_ctrl(size=0, inc_read=False, treq_sel=dreq(sm_num, True))
+        # Transfer words, don't increment the read address and pace the transfer.
+        # Byte swap restores the order of bytes shifted in MSB first.
+        tsel = dreq(sm_num, True)
+        self._cfg = self._dma.pack_ctrl(size=2, inc_read=False, bswap=True, treq_sel=tsel)
         # Input (MOSI) SM
         self._buf = buf
         self._nbytes = 0  # Number of received bytes
+        self._rbuf = None  # Buffer currently receiving (for ISR)
         if buf is not None:
+            _aligncheck(buf)
             self._mvb = memoryview(buf)
+        self._bufs = None  # Ping-pong buffers for asynchronous iterator
+        self._bidx = 0  # Index of buffer currently receiving
+        self._armed = False  # Iterator has initiated a read into ._bufs[._bidx]
+        self._running = False  # Read DMA and SM are active
+        # The ISR is a scheduled callback which can run while asyncio is manipulating
+        # its task queue. Event.set() is not safe in that context: ThreadSafeFlag is.
         self._tsf = asyncio.ThreadSafeFlag()
         self._read_done = False  # Synchronisation for .read()
+        self._missed = False  # ISR detected a transmission that was never read
         # IRQ occurs at end of transfer
         csn.irq(self._done, trigger=Pin.IRQ_RISING, hard=False)
         self._sm = rp2.StateMachine(
             sm_num,
-            spi_in,
+            _PROGS[bits][0],
             in_shiftdir=rp2.PIO.SHIFT_LEFT,
-            push_thresh=8,
+            push_thresh=32,
             in_base=mosi,
             jmp_pin=sck,
         )
+        # Bound methods used in the start and ISR paths: avoids repeated lookups.
+        self._dma_active = self._dma.active
+        self._dma_config = self._dma.config
+        self._sm_active = self._sm.active
+        self._sm_restart = self._sm.restart
+        self._sm_put = self._sm.put
+        self._tsf_set = self._tsf.set
+        self._tsf_clear = self._tsf.clear
+        # Address of the SM's RX FIFO register: RP2040 datasheet 3.7 RP2350 11.7.
+        # Reading it directly in the ISR avoids the .get() call.
+        self._rxf = 0x5020_0000 + ((sm_num >> 2) << 20) + 0x20 + ((sm_num & 3) << 2)
         if self._io:
             # Output (MISO) SM
             # Write DMA
             self._wdma = rp2.DMA()
-            self._wcfg = self._wdma.pack_ctrl(size=0, inc_write=False, treq_sel=dreq(sm_num + 1))
+            # Transfer one frame at a time. Byte swap sends multi-byte frames MSB first.
+            self._wcfg = self._wdma.pack_ctrl(
+                size=self._wshift, inc_write=False, bswap=bits > 8, treq_sel=dreq(sm_num + 1)
+            )
             self._osm = rp2.StateMachine(
                 sm_num + 1,
-                spi_out,
-                pull_thresh=8,
+                _PROGS[bits][1],
+                pull_thresh=bits,
                 in_base=mosi,
                 out_base=miso,
             )
+            self._wdma_active = self._wdma.active
+            self._wdma_config = self._wdma.config
+            self._osm_active = self._osm.active
+            self._osm_restart = self._osm.restart
 
     def __aiter__(self):  # Asynchronous iterator support
+        self._bufcheck()  # Ensure there is a valid buffer
+        if self._bufs is None:  # Allocate second buffer on first use
+            b = bytearray(len(self._buf))
+            self._bufs = (self._buf, b)
+            self._mvbs = (self._mvb, memoryview(b))
         return self
 
+    # A read into the other buffer is initiated before returning, so the SM is armed
+    # while user code processes the message. The oldest queued write is armed with it:
+    # a .write() made while processing the message is safe (the in-flight buffer is
+    # not touched) but is sent no earlier than the transfer after next.
     async def __anext__(self):
-        self._bufcheck()  # Ensure there is a valid buffer
-        self._rinto(self._buf)  # Initiate DMA and return.
+        idx = self._bidx
+        if not self._armed:  # First pass or another read method was used
+            self._rinto(self._bufs[idx])  # Initiate DMA and return.
         await self._tsf.wait()  # Wait for CS/ high (master signals transfer complete)
-        return self._mvb[: self._nbytes]
+        self._chkmissed()
+        n = self._nbytes
+        self._bidx = idx ^ 1
+        self._rinto(self._bufs[idx ^ 1])
+        self._armed = True
+        return self._mvbs[idx][:n]
 
     def _bufcheck(self):
         if self._buf is None:
             raise OSError("No buffer provided to constructor.")
 
+    def _chkmissed(self):  # Report ISR diagnostic outside of the ISR
+        if self._missed:
+            self._missed = False
+            print("Missed TX?")
+
     def read(self):  # Blocking read, own buffer
         self._bufcheck()
         self._read_done = False
         self._rinto(self._buf)
         while not self._read_done:
-            pass
+            idle()  # WFE: CS/ interrupt wakes the CPU
+        self._chkmissed()
         return self._mvb[: self._nbytes]
 
     # Initiate a nonblocking read into a buffer. Immediate return.
     def read_into(self, buf):
         if self._callback is not None:
+            _aligncheck(buf)
             self._docb = True
             self._rinto(buf)
         else:
             raise ValueError("Missing callback function.")
 
-    # Queue a buffer for transmission.
-    def write(self, buf):
+    # Queue a buffer for transmission. Data is copied into a queue slot's buffer: this
+    # is only reallocated if a longer message is written to that slot. A buffer being
+    # read by the DMA is never modified.
+    # If copy is False the caller's buffer is sent directly. It must not be modified
+    # until it has been sent.
+    def write(self, buf, copy=True):
         if not self._io:
             raise ValueError("Write error: no MISO specified.")
-        self._wq.append(buf[:])  # Copy in case caller modifies before it's sent
+        if self._wcount >= self._wqlen:
+            raise OSError("Write queue is full.")
+        i = (self._whead + self._wcount) % self._wnslots  # Slot for new message
+        n = len(buf)
+        if copy:
+            b = self._wbuf[i]
+            if b is None or n > len(b):
+                b = bytearray(n)
+                self._wbuf[i] = b
+                self._wmv[i] = memoryview(b)
+            self._wmv[i][:n] = buf  # Copy in case caller modifies before it's sent
+            buf = b
+        addr = addressof(buf)
+        if addr & ((1 << self._wshift) - 1):  # Only possible if copy is False
+            raise ValueError("Buffer must be aligned to frame size.")
+        self._wsrc[i] = buf
+        self._waddr[i] = addr  # DMA accepts an address: no buffer lookup in _rinto
+        self._wlen[i] = n >> self._wshift  # Any partial frame is not sent
+        self._wcount += 1
 
+    @micropython.native
     def _rinto(self, buf):  # .read_into() without callback
+        dma_active = self._dma_active
+        sm_active = self._sm_active
         buflen = len(buf)
         self._buflen = buflen  # Save for ISR
-        self._dma.active(0)  # De-activate befor re-configuring
-        self._sm.active(0)
-        self._tsf.clear()
-        self._dma.config(read=self._sm, write=buf, count=buflen, ctrl=self._cfg)
+        self._rbuf = buf
+        self._armed = False
+        running = self._running
+        if running:  # De-activate befor re-configuring. ISR has done this if it ran.
+            dma_active(0)
+            sm_active(0)
+        self._tsf_clear()
+        self._dma_config(read=self._sm, write=buf, count=buflen >> 2, ctrl=self._cfg)
         if self._io:
-            self._wdma.active(0)
-            self._osm.active(0)
-            if len(self._wq):  # Queue is not empty
-                wb = self._wq.pop(0)  # Assign oldest message to write buffer
+            wdma_active = self._wdma_active
+            osm_active = self._osm_active
+            if running:
+                wdma_active(0)
+            osm_active(0)
+            n = 0
+            if self._wcount:  # Dequeue oldest message
+                i = self._whead
+                n = self._wlen[i]
+                addr = self._waddr[i]
+                self._wfly = self._wsrc[i]  # Retain a reference until the transfer ends
+                self._wsrc[i] = None
+                self._whead = (i + 1) % self._wnslots
+                self._wcount -= 1
+            if n:
                 # Write buffer can be bigger than read buf. SPI interface causes write data
                 # to be truncated to length of data sent by master.
-                n = len(wb)
-                print("sending", n, wb[:n])
-                self._wdma.config(read=wb, write=self._osm, count=n, ctrl=self._wcfg, trigger=True)
-                self._wdma.active(1)
-                self._osm.restart()  # osm waits for CS/ low
-                self._osm.active(1)
-
-        self._dma.active(1)
-        self._sm.restart()
-        self._sm.active(1)  # Start SM
-        self._sm.put(buflen, 3)  # Number of expected bits
+                self._wdma_config(
+                    read=addr, write=self._osm, count=n, ctrl=self._wcfg, trigger=True
+                )
+                wdma_active(1)
+                self._osm_restart()  # osm waits for CS/ low
+                osm_active(1)
+
+        dma_active(1)
+        # Preload the TX FIFO with the number of expected bits while the SM is stopped.
+        # The FIFO is empty so this never blocks, and the SM's initial out(y, 32)
+        # completes as soon as it starts.
+        self._sm_put(buflen, 3)
+        self._sm_restart()
+        sm_active(1)  # Start SM
+        self._running = True
 
     # Hard ISR for CS/ rising edge.
     # This is dependent on the integrity of the logic signals. Poor wiring can cause
     # spurious IRQ's and erratic SM behaviour leading to invalid data, memfails, etc.
+    @micropython.native
     def _done(self, _):  # Get no. of bytes received.
-        self._dma.active(0)
-        if self._io:
-            self._wdma.active(0)
-        self._sm.put(0)  # Request no. of received bits
-        if not self._sm.rx_fifo():  # Occurs if ._rinto() never called while CSN is low:
+        if not self._running:  # Occurs if ._rinto() never called while CSN is low:
             # master has sent data that was never read. A transmission was missed.
-            print("Missed TX?")
+            self._missed = True  # Reported by the reading code: no print in ISR
             return  # ISR runs on trailing edge but SM is not running. Nothing to do.
+        self._dma_active(0)
+        if self._io:
+            self._wdma_active(0)
+            self._wfly = None  # Release buffer: DMA has stopped
+        self._sm_put(0)  # Request no. of received bits
+        if self._sm.rx_fifo() < 2:  # SM did not respond: see above comment re wiring
+            self._missed = True
+            return
+        rxf = self._rxf
+        tail = mem32[rxf]  # Partial word: last (nbytes & 3) bytes
         # See above comment re memfails on next line
-        sp = self._sm.get() >> 3  # Bits->bytes: space left in buffer or 7ffffff on overflow
-        self._nbytes = self._buflen - sp if sp != 0x07FF_FFFF else self._buflen
-        self._dma.active(0)
-        self._sm.active(0)
-        self._tsf.set()
+        sp = mem32[rxf] >> 3  # Bits->bytes: space left in buffer or 7ffffff on overflow
+        buflen = self._buflen
+        # Overflow value exceeds any buffer length so no constant is needed.
+        if sp <= buflen:
+            nbytes = buflen - sp
+        else:  # Overrun: SM input one bit beyond the buffer before detecting it
+            nbytes = buflen
+            tail >>= 1  # Discard it
+        self._nbytes = nbytes
+        n = nbytes & 3
+        if n:  # Bytes in tail are right justified, MSB first
+            buf = self._rbuf
+            i = nbytes - n
+            while n:
+                n -= 1
+                buf[i + n] = tail & 0xFF
+                tail >>= 8
+        self._sm_active(0)
+        self._running = False
         self._read_done = True
         if self._docb:  # Only run CB if user has called .read_into()
             self._docb = False
             schedule(self._callback, self._nbytes)  # Soft ISR
+        # Ordering: the waiting task is notified last, when all state is updated and
+        # any callback has been queued. The callback therefore precedes the task.
+        self._tsf_set()
 
     # Await a read into a user-supplied buffer. Return no. of bytes read.
     async def as_read_into(self, buf):
+        _aligncheck(buf)
         self._rinto(buf)  # Start the read
         await self._tsf.wait()  # Wait for CS/ high (master signals transfer complete)
+        self._chkmissed()
         return self._nbytes
 
     def deinit(self):